@@ -5,55 +5,197 @@ All of the implementations I found were either resource-based or really ugly.
 
 """
 
+import collections
 import itertools
+import mmap
+import os
+import tempfile
 
-from twisted.internet import defer, error, protocol
+from twisted.internet import defer, error, interfaces, protocol
 from twisted.protocols import basic
 from twisted.python import failure, log
+from zope.interface import implementer
 
 from txjsonrpc import jsonrpclib
 
 
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _writeSharedMemory(string):
+    """
+    Copy ``string`` into an anonymous (tmpfs-backed where possible) file.
+
+    """
+
+    shared = tempfile.TemporaryFile(dir=SHARED_MEMORY_DIR)
+    shared.write(string)
+    shared.flush()
+    return shared
+
+
+def _readSharedMemory(fd, size):
+    """
+    Read ``size`` bytes out of the shared memory behind ``fd``, closing it.
+
+    """
+
+    try:
+        mapped = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+    try:
+        return mapped[:]
+    finally:
+        mapped.close()
+
+
+@implementer(interfaces.IFileDescriptorReceiver)
 class JSONRPC(basic.Int16StringReceiver):
 
+    _advertised = False
+    _attachments = None
     _failAllReason = None
+    _heardFromPeer = False
+    cancelledLimit = 1000
+    extensions = (jsonrpclib.ATTACHMENTS,)
+    maxAttachmentLength = 2 ** 26
+    maxSharedMemoryLength = 2 ** 26
+    peerExtensions = None
+    sharedMemoryThreshold = None
     transport = None
 
     def __init__(self):
         self._counter = itertools.count(1)
         self._requests = {}
+        self._cancelled = collections.OrderedDict()
+        self._receivedDescriptors = collections.deque()
+        self._sentSharedMemory = collections.deque()
+        self._waitingForPeerExtensions = []
 
     def connectionMade(self):
         self.transport.protocol = self
-        host, peer = self.transport.getHost(), self.transport.getPeer()
+        # UNIX transports can't be asked for addresses once they're closed
+        self._addresses = self.transport.getHost(), self.transport.getPeer()
         log.msg("JSON RPC connection established (HOST: {}, PEER: {})".format(
-            host, peer
+            *self._addresses
         ))
 
     def connectionLost(self, reason):
-        host, peer = self.transport.getHost(), self.transport.getPeer()
+        host, peer = self._addresses
         log.msg(
             "JSON RPC connection lost (HOST: {}, PEER: {})".format(host, peer)
         )
 
+        self.connected = False
         self.transport = None
         self.failAll(reason)
 
+        while self._receivedDescriptors:
+            os.close(self._receivedDescriptors.popleft())
+        while self._sentSharedMemory:
+            self._sentSharedMemory.popleft().close()
+
+    def fileDescriptorReceived(self, descriptor):
+        self._receivedDescriptors.append(descriptor)
 
     def stringReceived(self, string):
+        if self._attachments is not None:
+            return self._receivedAttachmentFrame(string)
+
         try:
             received = jsonrpclib.loads(string)
         except jsonrpclib.ParseError:
             return self.unhandledError(failure.Failure())
 
+        if "sharedMemory" in received:
+            return self._receivedSharedMemory(received)
+        elif "sharedMemoryReceived" in received:
+            return self._sharedMemoryReceived()
+        elif jsonrpclib.ATTACHMENTS in received:
+            return self._receivedWithAttachments(received)
+        return self._receivedMessage(received)
+
+    def _receivedMessage(self, received):
+        if not self._heardFromPeer:
+            self._receivedPeerExtensions(received)
+
         if "result" in received or "error" in received:
             return self._receivedResult(received)
         else:
             return self._receivedRequest(received)
 
+    def _receivedSharedMemory(self, reference):
+        try:
+            size = jsonrpclib.receivedSharedMemory(
+                reference, self.maxSharedMemoryLength,
+            )
+            if not self._receivedDescriptors:
+                raise jsonrpclib.InvalidRequest(
+                    {"reason" : "No file descriptor for shared memory"}
+                )
+        except jsonrpclib.JSONRPCError:
+            return self.unhandledError(failure.Failure())
+
+        fd = self._receivedDescriptors.popleft()
+        # we hold our own copy of the descriptor now, so the peer can let go
+        basic.Int16StringReceiver.sendString(
+            self, jsonrpclib.sharedMemoryReceived(),
+        )
+
+        try:
+            string = _readSharedMemory(fd, size)
+        except (EnvironmentError, OverflowError, ValueError):
+            return self.unhandledError(failure.Failure())
+        return self.stringReceived(string)
+
+    def _sharedMemoryReceived(self):
+        if not self._sentSharedMemory:
+            reason = {"reason" : "No shared memory was sent"}
+            err = failure.Failure(jsonrpclib.InvalidRequest(reason))
+            return self.unhandledError(err)
+        self._sentSharedMemory.popleft().close()
+
+    def _receivedWithAttachments(self, message):
+        try:
+            sizes = jsonrpclib.receivedAttachments(
+                message, self.maxAttachmentLength,
+            )
+        except jsonrpclib.JSONRPCError:
+            return self.unhandledError(failure.Failure())
+
+        self._attachments = _AttachmentCollector(message, sizes)
+        if self._attachments.done:
+            return self._receivedAllAttachments()
+
+    def _receivedAttachmentFrame(self, frame):
+        try:
+            self._attachments.frameReceived(frame)
+        except jsonrpclib.JSONRPCError:
+            self._attachments = None
+            return self.unhandledError(failure.Failure())
+
+        if self._attachments.done:
+            return self._receivedAllAttachments()
+
+    def _receivedAllAttachments(self):
+        collector, self._attachments = self._attachments, None
+        try:
+            message = jsonrpclib.resolveAttachments(
+                collector.message, collector.attachments,
+            )
+        except jsonrpclib.JSONRPCError:
+            return self.unhandledError(failure.Failure())
+        return self._receivedMessage(message)
+
     def _receivedResult(self, result):
         id = result.get("id")
 
+        if id in self._cancelled:
+            del self._cancelled[id]
+            return
+
         try:
             d = self._requests.pop(id).addErrback(self.unhandledError, id=id)
         except KeyError:
@@ -80,18 +222,132 @@ class JSONRPC(basic.Int16StringReceiver):
         d = defer.maybeDeferred(req["method"], *req["args"], **req["kwargs"])
 
         if id is not None:
-            d.addCallback(lambda res : jsonrpclib.response(id, res))
+            d.addCallback(self._buildResponse, id)
 
         # we want invalid notifications to cause errors too, so no addCallbacks
         d.addErrback(self.unhandledError, id=id)
 
         if id is not None:
-            d.addCallback(self.sendString)
+            d.addCallback(self._sendMessage)
+
+    def _buildResponse(self, result, id):
+        attachments = []
+        string = jsonrpclib.response(
+            id, result, attachments, extensions=self._advertisement(),
+        )
+        if not attachments:
+            return string, attachments
+
+        d = self._requireAttachmentSupport()
+        d.addCallback(lambda _ : (string, attachments))
+        return d.addErrback(self._attachmentsRefused, id)
+
+    def _attachmentsRefused(self, reason, id):
+        # Not the handler's fault, nor the peer's, so don't drop the connection
+        reason.trap(jsonrpclib.AttachmentsNotSupported)
+        log.msg(
+            "Could not send attachments in the response to request {!r}: "
+            "{}".format(id, reason.value.data["reason"])
+        )
+        error = jsonrpclib.error(id, reason, extensions=self._advertisement())
+        return error, []
+
+    def _advertisement(self):
+        if not self._advertised:
+            return self.extensions
+
+    def _requireAttachmentSupport(self):
+        """
+        Fire once the peer is known to support attachments.
+
+        Peers advertise their extensions in the first message they send,
+        which is how ones that predate extensions (and would drop the
+        connection on anything they don't understand) are told apart without
+        sending them anything. Until the peer has said anything, calls wait
+        for the answer to an outstanding request, or fail if there is none.
+
+        """
+
+        if self.peerExtensions is not None:
+            d = defer.succeed(self.peerExtensions)
+        elif self._requests:
+            d = defer.Deferred()
+            self._waitingForPeerExtensions.append(d)
+        else:
+            return defer.fail(jsonrpclib.AttachmentsNotSupported({
+                "reason" : "The peer has not yet said which extensions it "
+                           "supports, and has no requests to answer.",
+            }))
+
+        def check(extensions):
+            if jsonrpclib.ATTACHMENTS not in extensions:
+                raise jsonrpclib.AttachmentsNotSupported()
+        return d.addCallback(check)
+
+    def _receivedPeerExtensions(self, received):
+        self._heardFromPeer = True
+        self.peerExtensions = jsonrpclib.receivedExtensions(received)
+
+        waiting, self._waitingForPeerExtensions = (
+            self._waitingForPeerExtensions, [],
+        )
+        for d in waiting:
+            d.callback(self.peerExtensions)
+
+    def _sendMessage(self, message):
+        if self.transport is None:
+            raise error.ConnectionLost()
+
+        string, attachments = message
+        self.sendString(string)
+        for attachment in attachments:
+            self._sendAttachment(attachment)
+
+    def _sendAttachment(self, attachment):
+        # Attachments go out as raw frames, bypassing shared memory, since the
+        # peer reads them without parsing. Ones larger than fit in a single
+        # frame are split across as many as needed.
+        maximum = 2 ** (8 * self.prefixLength) - 1
+        for start in xrange(0, len(attachment), maximum):
+            basic.Int16StringReceiver.sendString(
+                self, attachment[start:start + maximum],
+            )
 
     def sendString(self, string):
         if self.transport is None:
             raise error.ConnectionLost()
-        basic.Int16StringReceiver.sendString(self, string)
+
+        if self._shouldUseSharedMemory(string):
+            self._sendSharedMemory(string)
+        else:
+            basic.Int16StringReceiver.sendString(self, string)
+        self._advertised = True
+
+    def _shouldUseSharedMemory(self, string):
+        return (
+            self.sharedMemoryThreshold is not None and
+            len(string) > self.sharedMemoryThreshold and
+            interfaces.IUNIXTransport.providedBy(self.transport)
+        )
+
+    def _sendSharedMemory(self, string):
+        """
+        Send ``string`` out of band, passing only a reference over the socket.
+
+        The payload is written to shared memory whose file descriptor is sent
+        to the peer with ``SCM_RIGHTS``, so large messages are neither copied
+        through the socket nor limited by the length prefix. The peer
+        acknowledges each reference once it has the descriptor, at which point
+        our copy is closed.
+
+        """
+
+        shared = _writeSharedMemory(string)
+        self._sentSharedMemory.append(shared)
+        self.transport.sendFileDescriptor(shared.fileno())
+
+        reference = jsonrpclib.sharedMemory(len(string))
+        basic.Int16StringReceiver.sendString(self, reference)
 
     def failAll(self, reason):
         self._failAllReason = reason
@@ -100,6 +356,12 @@ class JSONRPC(basic.Int16StringReceiver):
         for request in requests.itervalues():
             request.errback(reason)
 
+        waiting, self._waitingForPeerExtensions = (
+            self._waitingForPeerExtensions, [],
+        )
+        for d in waiting:
+            d.errback(reason)
+
     def unhandledError(self, failure, id=None):
         log.err(
             failure,
@@ -109,23 +371,53 @@ class JSONRPC(basic.Int16StringReceiver):
         )
 
         if self.transport is not None:
-            self.sendString(jsonrpclib.error(id, failure))
+            self.sendString(
+                jsonrpclib.error(id, failure, self._advertisement())
+            )
             self.transport.loseConnection()
 
     def _buildOutgoing(self, method, parameters, notification=False):
         if self._failAllReason is not None:
             return defer.fail(self._failAllReason)
 
+        attachments, extensions = [], self._advertisement()
         if notification:
-            toSend = jsonrpclib.notify(method, parameters)
+            toSend = jsonrpclib.notify(
+                method, parameters, attachments, extensions,
+            )
         else:
             id = str(next(self._counter))
-            toSend = jsonrpclib.request(id, method, parameters)
+            toSend = jsonrpclib.request(
+                id, method, parameters, attachments, extensions,
+            )
 
-        self.sendString(toSend)
+        if attachments:
+            sent = self._requireAttachmentSupport()
+            sent.addCallback(lambda _ : self._sendMessage((toSend, attachments)))
+        else:
+            sent = self.sendString(toSend)
 
-        if not notification:
-            return self._requests.setdefault(id, defer.Deferred())
+        if notification:
+            return sent
+
+        d = defer.Deferred(lambda _ : self._cancelRequest(id))
+        self._requests[id] = d
+        if attachments:
+            sent.addErrback(self._failRequest, id)
+        return d
+
+    def _cancelRequest(self, id):
+        # There's no way to tell the peer, so just ignore its eventual answer,
+        # unless it never comes and too many others have been cancelled since
+        if self._requests is not None and id in self._requests:
+            del self._requests[id]
+            self._cancelled[id] = None
+            if len(self._cancelled) > self.cancelledLimit:
+                self._cancelled.popitem(last=False)
+
+    def _failRequest(self, reason, id):
+        if self._requests is not None and id in self._requests:
+            self._requests.pop(id).errback(reason)
 
     def notify(self, method, parameters=()):
         return self._buildOutgoing(
@@ -141,10 +433,61 @@ class JSONRPC(basic.Int16StringReceiver):
 class JSONRPCFactory(protocol.Factory):
     protocol = JSONRPC
 
-    def __init__(self, lookupMethod=lambda name : None):
+    def __init__(
+        self, lookupMethod=lambda name : None, sharedMemoryThreshold=None,
+        peerExtensions=None,
+    ):
         self.lookupMethod = lookupMethod
+        self.sharedMemoryThreshold = sharedMemoryThreshold
+        self.peerExtensions = peerExtensions
 
     def buildProtocol(self, addr):
         proto = protocol.Factory.buildProtocol(self, addr)
         proto.lookupMethod = self.lookupMethod
+        proto.sharedMemoryThreshold = self.sharedMemoryThreshold
+        proto.peerExtensions = self.peerExtensions
         return proto
+
+
+class _AttachmentCollector(object):
+    """
+    Reassemble the attachments following a message from the raw frames.
+
+    """
+
+    def __init__(self, message, sizes):
+        self.message = message
+        self.attachments = []
+        self._sizes = collections.deque(sizes)
+        self._frames = []
+        self._received = 0
+        self._finishEmpty()
+
+    @property
+    def done(self):
+        return not self._sizes
+
+    def frameReceived(self, frame):
+        self._frames.append(frame)
+        self._received += len(frame)
+
+        if self._received > self._sizes[0]:
+            raise jsonrpclib.InvalidRequest({"reason" : "attachment size"})
+        elif self._received == self._sizes[0]:
+            if len(self._frames) == 1:
+                attachment, = self._frames
+            else:
+                # one more copy, but a memoryview onto a preallocated
+                # bytearray can't be sliced or sent on like the str it stands
+                # in for, so that's the least it can cost to hand out a str
+                attachment = "".join(self._frames)
+            self.attachments.append(attachment)
+
+            self._sizes.popleft()
+            self._frames, self._received = [], 0
+            self._finishEmpty()
+
+    def _finishEmpty(self):
+        while self._sizes and not self._sizes[0]:
+            self.attachments.append("")
+            self._sizes.popleft()
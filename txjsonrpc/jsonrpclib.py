@@ -63,11 +63,90 @@ class InvalidResponse(JSONRPCError):
     pass
 
 
+class AttachmentsNotSupported(JSONRPCError):
+    # outside the range reserved by the spec, so that peers which don't know
+    # about it still see the message rather than a generic "Server error"
+    code = -31001
+    message = "Attachments not supported by peer"
+
+    def __init__(self, data=None, *args, **kwargs):
+        if data is None:
+            data = {
+                "reason" : "The peer did not advertise support for binary "
+                           "attachments, so none were sent."
+            }
+        super(AttachmentsNotSupported, self).__init__(data, *args, **kwargs)
+
+
 _e = {ParseError, InvalidRequest, MethodNotFound, InvalidParams, InternalError}
 PROTOCOL_ERRORS = {error.code : error for error in _e}
+EXTENSION_ERRORS = {AttachmentsNotSupported.code : AttachmentsNotSupported}
+
+ATTACHMENTS = "attachments"
+
+
+class Attachment(object):
+    """
+    Binary data to be sent as a raw frame alongside a message.
+
+    Wherever an :class:`Attachment` appears in the parameters or result of a
+    message, the JSON body carries an ``{"$attachment" : index}`` reference
+    instead, and the peer receives the data itself as a ``str``.
+
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        return "<Attachment ({} bytes)>".format(len(self.data))
+
+
+def _dumps(message, attachments, extensions):
+    if extensions:
+        message["extensions"] = list(extensions)
+    if attachments is None:
+        return json.dumps(message)
+
+    def default(obj):
+        # only called for what json can't encode itself, so messages without
+        # attachments cost no more to encode than they did before them
+        if not isinstance(obj, Attachment):
+            raise TypeError("{!r} is not JSON serializable".format(obj))
+        attachments.append(obj.data)
+        return {"$attachment" : len(attachments) - 1}
+
+    encoded = json.dumps(message, default=default)
+    if not attachments:
+        return encoded
+
+    # the sizes are only known once the rest is encoded, so splice them in
+    sizes = json.dumps([len(each) for each in attachments])
+    return '{}, "{}": {}}}'.format(encoded[:-1], ATTACHMENTS, sizes)
+
 
+def _isCount(value):
+    return (
+        isinstance(value, (int, long)) and
+        not isinstance(value, bool) and
+        value >= 0
+    )
 
-def error(id, failure):
+
+def resolveAttachments(obj, attachments):
+    if isinstance(obj, dict):
+        if obj.keys() == ["$attachment"]:
+            index = obj["$attachment"]
+            if not _isCount(index) or index >= len(attachments):
+                raise InvalidRequest({"reason" : "$attachment"})
+            return attachments[index]
+        return {k : resolveAttachments(v, attachments) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [resolveAttachments(each, attachments) for each in obj]
+    return obj
+
+
+def error(id, failure, extensions=None):
     tr = getattr(failure.value, "toResponse", None)
     if tr is None:
         tr = InternalError({
@@ -75,21 +154,31 @@ def error(id, failure):
             "exception" : failure.type.__name__,
             "traceback" : failure.getTraceback(),
         }).toResponse
-    return json.dumps({"jsonrpc" : "2.0", "id" : id, "error" : tr()})
+    err = {"jsonrpc" : "2.0", "id" : id, "error" : tr()}
+    return _dumps(err, None, extensions)
 
 
-def notify(method, params=()):
+def notify(method, params=(), attachments=None, extensions=None):
     notification = {"jsonrpc" : "2.0", "method" : method, "params" : params}
-    return json.dumps(notification)
+    return _dumps(notification, attachments, extensions)
 
 
-def request(id, method, params=()):
+def request(id, method, params=(), attachments=None, extensions=None):
     req = {"jsonrpc" : "2.0", "id" : id, "method" : method, "params" : params}
-    return json.dumps(req)
+    return _dumps(req, attachments, extensions)
+
+
+def response(id, result, attachments=None, extensions=None):
+    res = {"jsonrpc" : "2.0", "id" : id, "result" : result}
+    return _dumps(res, attachments, extensions)
 
 
-def response(id, result):
-    return json.dumps({"jsonrpc" : "2.0", "id" : id, "result" : result})
+def sharedMemory(size):
+    return json.dumps({"jsonrpc" : "2.0", "sharedMemory" : {"size" : size}})
+
+
+def sharedMemoryReceived():
+    return json.dumps({"jsonrpc" : "2.0", "sharedMemoryReceived" : True})
 
 
 def loads(data):
@@ -121,6 +210,8 @@ def receivedResult(recv):
 
         if code in PROTOCOL_ERRORS:
             raise PROTOCOL_ERRORS[code](data=data)
+        elif code in EXTENSION_ERRORS:
+            raise EXTENSION_ERRORS[code](data=data)
         else:
             try:
                 err = ServerError(code=code, data=data)
@@ -132,6 +223,36 @@ def receivedResult(recv):
     return recv
 
 
+def receivedSharedMemory(recv, maximum=None):
+    if "jsonrpc" not in recv:
+        raise InvalidRequest({"reason" : "jsonrpc"})
+
+    try:
+        size = int(recv["sharedMemory"]["size"])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidRequest({"reason" : "sharedMemory"})
+
+    if size <= 0 or maximum is not None and size > maximum:
+        raise InvalidRequest({"reason" : "sharedMemory"})
+    return size
+
+
+def receivedExtensions(recv):
+    extensions = recv.get("extensions")
+    if not isinstance(extensions, list):
+        return []
+    return extensions
+
+
+def receivedAttachments(recv, maximum=None):
+    sizes = recv[ATTACHMENTS]
+    if not isinstance(sizes, list) or not all(map(_isCount, sizes)):
+        raise InvalidRequest({"reason" : ATTACHMENTS})
+    elif maximum is not None and sum(sizes) > maximum:
+        raise InvalidRequest({"reason" : ATTACHMENTS})
+    return sizes
+
+
 def receivedRequest(recv, lookupMethod):
     if "jsonrpc" not in recv:
         raise InvalidRequest({"reason" : "jsonrpc"})
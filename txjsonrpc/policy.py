@@ -0,0 +1,269 @@
+"""
+Client-side policies for keeping tail latency down: hedging and retrying.
+
+Both only ever apply to methods the application declares idempotent, since
+either may cause the same request to be executed more than once.
+
+"""
+
+import collections
+import itertools
+import random
+
+from twisted.internet import defer, error
+from twisted.python import failure
+
+from txjsonrpc import jsonrpclib
+
+
+class RetryBudget(object):
+    """
+    Limit the extra load hedges and retries can put on the servers.
+
+    Every original request deposits ``ratio`` tokens, up to ``capacity``, and
+    every hedge or retry needs a whole one. Once the servers start failing,
+    the extra requests sent therefore stay a fixed fraction of the ordinary
+    ones, rather than multiplying them.
+
+    """
+
+    def __init__(self, ratio=0.1, capacity=10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Hedge(object):
+    """
+    Send a duplicate request if no answer has arrived after a while.
+
+    The delay is either fixed, or, if ``delay`` is ``None``, the given
+    ``percentile`` of the latencies observed for the method over the last
+    ``window`` answers. No hedges are sent until ``minimumSamples`` answers
+    have been seen.
+
+    """
+
+    def __init__(
+        self, delay=None, percentile=0.95, window=100, minimumSamples=20,
+    ):
+        self.delay = delay
+        self.percentile = percentile
+        self.window = window
+        self.minimumSamples = minimumSamples
+
+    def delayFor(self, latencies):
+        if self.delay is not None:
+            return self.delay
+        elif len(latencies) < self.minimumSamples:
+            return None
+
+        ordered = sorted(latencies)
+        index = int(self.percentile * len(ordered))
+        return ordered[min(index, len(ordered) - 1)]
+
+
+class Retry(object):
+    """
+    Retry requests which failed with one of the given error ``codes``.
+
+    Up to ``maximum`` retries are made, each after a randomly chosen delay of
+    up to ``initialDelay * 2 ** retriesSoFar`` (capped at ``maximumDelay``).
+
+    """
+
+    def __init__(
+        self, codes,
+        maximum=3, initialDelay=0.05, maximumDelay=2.0, random=random.random,
+    ):
+        self.codes = frozenset(codes)
+        self.maximum = maximum
+        self.initialDelay = initialDelay
+        self.maximumDelay = maximumDelay
+        self.random = random
+
+    def shouldRetry(self, reason, retries):
+        if retries >= self.maximum:
+            return False
+        elif not reason.check(jsonrpclib.JSONRPCError):
+            return False
+        return getattr(reason.value, "code", None) in self.codes
+
+    def delayFor(self, retries):
+        ceiling = min(self.maximumDelay, self.initialDelay * 2 ** retries)
+        return self.random() * ceiling
+
+
+class PolicyClient(object):
+    """
+    Make requests over a set of connections, hedging and retrying them.
+
+    ``connections`` take turns carrying new requests, and a hedge or retry
+    goes out on the connection after the one the call's previous attempt used,
+    so that it reaches a different server than the attempt before it whenever
+    more than one is given. Connections which are no longer connected are
+    skipped. Requests for methods not in ``idempotent`` are passed
+    straight through; ones which are get sent again on the next connection if
+    theirs is lost.
+
+    """
+
+    def __init__(
+        self, connections, idempotent=(),
+        hedge=None, retry=None, budget=None, clock=None,
+    ):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        if budget is None:
+            budget = RetryBudget()
+
+        self.connections = list(connections)
+        self.idempotent = frozenset(idempotent)
+        self.hedge = hedge
+        self.retry = retry
+        self.budget = budget
+        self.clock = clock
+
+        self._turns = itertools.count()
+        self._latencies = {}
+
+    def latencies(self, method):
+        latencies = self._latencies.get(method)
+        if latencies is None:
+            window = self.hedge.window if self.hedge is not None else 100
+            latencies = self._latencies[method] = collections.deque(
+                maxlen=window,
+            )
+        return latencies
+
+    def _next(self, after=None):
+        if after is None:
+            start = next(self._turns)
+        else:
+            start = self.connections.index(after) + 1
+
+        count = len(self.connections)
+        for offset in xrange(count):
+            connection = self.connections[(start + offset) % count]
+            if connection.connected:
+                break
+        return connection
+
+    def notify(self, method, parameters=()):
+        return self._next().notify(method, parameters)
+
+    def request(self, method, parameters=()):
+        if method not in self.idempotent:
+            return self._next().request(method, parameters)
+
+        self.budget.deposit()
+        return _Call(self, method, parameters).start()
+
+
+class _Call(object):
+    """
+    A single logical request, and all of the attempts made to answer it.
+
+    """
+
+    _done = False
+
+    def __init__(self, client, method, parameters):
+        self.client = client
+        self.method = method
+        self.parameters = parameters
+
+        self.resends = self.retries = 0
+        self.result = defer.Deferred(lambda _ : self._stop())
+
+        self._attempts = set()
+        self._connection = None
+        self._hedge = None
+        self._retries = set()
+
+    def start(self):
+        self.started = self.client.clock.seconds()
+
+        hedge = self.client.hedge
+        if hedge is not None:
+            delay = hedge.delayFor(self.client.latencies(self.method))
+            if delay is not None:
+                self._hedge = self.client.clock.callLater(delay, self._hedged)
+
+        self._attempt()
+        return self.result
+
+    def _attempt(self):
+        self._connection = self.client._next(after=self._connection)
+        d = self._connection.request(self.method, self.parameters)
+        self._attempts.add(d)
+        d.addBoth(self._answered, d)
+
+    def _hedged(self):
+        self._hedge = None
+        if self.client.budget.withdraw():
+            self._attempt()
+
+    def _retry(self, delay):
+        def fire():
+            self._retries.discard(call)
+            self._attempt()
+        call = self.client.clock.callLater(delay, fire)
+        self._retries.add(call)
+
+    def _answered(self, result, attempt):
+        self._attempts.discard(attempt)
+        if self._done:
+            return
+
+        if not isinstance(result, failure.Failure):
+            # of the whole call, since timing only the attempt which answered
+            # would hide how slow the ones hedged against were
+            latency = self.client.clock.seconds() - self.started
+            self.client.latencies(self.method).append(latency)
+            self._stop()
+            return self.result.callback(result)
+
+        retry = self.client.retry
+        if (
+            result.check(error.ConnectionClosed) and
+            self.resends < len(self.client.connections)
+        ):
+            # never answered, so not extra load, and not worth waiting for
+            self.resends += 1
+            self._attempt()
+        elif (
+            retry is not None and
+            retry.shouldRetry(result, self.retries) and
+            self.client.budget.withdraw()
+        ):
+            self._retry(retry.delayFor(self.retries))
+            self.retries += 1
+        elif not self._attempts and not self._retries:
+            self._stop()
+            self.result.errback(result)
+
+    def _stop(self):
+        self._done = True
+
+        if self._hedge is not None:
+            self._hedge.cancel()
+            self._hedge = None
+
+        retries, self._retries = self._retries, set()
+        for call in retries:
+            call.cancel()
+
+        attempts, self._attempts = self._attempts, set()
+        for attempt in attempts:
+            attempt.cancel()
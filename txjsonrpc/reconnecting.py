@@ -0,0 +1,222 @@
+"""
+A client which survives its connection dropping.
+
+A :class:`ReconnectingClient` keeps one ``request()`` / ``notify()`` API across
+however many connections it goes through. Calls made while it is reconnecting
+are buffered until the next connection, and idempotent requests that were in
+flight when a connection dropped are sent again on the next one rather than
+failing.
+
+"""
+
+import collections
+
+from twisted.internet import defer, error
+from twisted.python import failure
+
+from txjsonrpc import jsonrpc, jsonrpclib
+
+
+class BufferFull(Exception):
+    """
+    Too many calls have been buffered while waiting to reconnect.
+
+    """
+
+
+class _Protocol(jsonrpc.JSONRPC):
+    def connectionLost(self, reason):
+        # first, so that calls made as the pending ones fail get buffered
+        self.factory.client._connectionLost(self)
+        jsonrpc.JSONRPC.connectionLost(self, reason)
+
+
+class _Factory(jsonrpc.JSONRPCFactory):
+    protocol = _Protocol
+
+    def __init__(self, client, **kwargs):
+        jsonrpc.JSONRPCFactory.__init__(self, **kwargs)
+        self.client = client
+
+
+class _Call(object):
+    def __init__(self, method, parameters, notification):
+        self.method = method
+        self.parameters = parameters
+        self.notification = notification
+        self.result = self.sent = None
+        self.resends = 0
+
+
+class ReconnectingClient(object):
+    """
+    Make requests over ``endpoint``, reconnecting whenever the connection goes.
+
+    Reconnection attempts back off exponentially, from ``initialDelay`` up to
+    ``maximumDelay`` seconds, and only start again from ``initialDelay`` once
+    a connection has answered a request or stayed up for ``maximumDelay``
+    seconds. At most ``bufferLimit`` new calls are held while disconnected;
+    beyond that they fail with :exc:`BufferFull`. An idempotent request is
+    sent at most ``maxResends`` more times before failing with whatever lost
+    its last connection.
+
+    """
+
+    _connectedAt = None
+    _connecting = None
+    _protocol = None
+    _reconnect = None
+    _stopped = True
+
+    def __init__(
+        self, endpoint, idempotent=(), bufferLimit=100, maxResends=5,
+        initialDelay=1.0, maximumDelay=60.0, factor=2.0, clock=None,
+        **factoryKwargs
+    ):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.endpoint = endpoint
+        self.idempotent = frozenset(idempotent)
+        self.bufferLimit = bufferLimit
+        self.maxResends = maxResends
+        self.initialDelay = initialDelay
+        self.maximumDelay = maximumDelay
+        self.factor = factor
+        self.clock = clock
+
+        self.factory = _Factory(self, **factoryKwargs)
+        self.failures = 0
+
+        self._buffer = collections.deque()
+
+    @property
+    def connected(self):
+        return self._protocol is not None
+
+    def start(self):
+        self._stopped = False
+        if self._protocol is None and self._connecting is None:
+            self._connect()
+
+    def stop(self):
+        self._stopped = True
+
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+            self._reconnect = None
+        if self._connecting is not None:
+            self._connecting.cancel()
+
+        reason = failure.Failure(error.ConnectionDone("Client was stopped."))
+        buffered, self._buffer = self._buffer, collections.deque()
+        for call in buffered:
+            if call.result is not None:
+                call.result.errback(reason)
+
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+    def notify(self, method, parameters=()):
+        return self._call(_Call(method, parameters, notification=True))
+
+    def request(self, method, parameters=()):
+        return self._call(_Call(method, parameters, notification=False))
+
+    def _call(self, call):
+        if not call.notification:
+            call.result = defer.Deferred(lambda _ : self._cancel(call))
+
+        if self._protocol is not None:
+            return self._send(call)
+        elif len(self._buffer) >= self.bufferLimit:
+            return defer.fail(BufferFull(self.bufferLimit))
+
+        self._buffer.append(call)
+        return call.result
+
+    def _cancel(self, call):
+        if call in self._buffer:
+            self._buffer.remove(call)
+        elif call.sent is not None:
+            call.sent.cancel()
+
+    def _send(self, call):
+        if call.notification:
+            return self._protocol.notify(call.method, call.parameters)
+
+        call.sent = defer.maybeDeferred(
+            self._protocol.request, call.method, call.parameters,
+        )
+        call.sent.addCallbacks(
+            self._succeeded, self._failed,
+            callbackArgs=(call,), errbackArgs=(call,),
+        )
+        return call.result
+
+    def _succeeded(self, result, call):
+        call.sent = None
+        self.failures = 0
+        call.result.callback(result)
+
+    def _failed(self, reason, call):
+        call.sent = None
+
+        if reason.check(jsonrpclib.JSONRPCError):
+            # still an answer, so the peer is up
+            self.failures = 0
+        elif (
+            reason.check(error.ConnectionClosed) and
+            call.method in self.idempotent and
+            call.resends < self.maxResends and
+            not self._stopped
+        ):
+            # resent ahead of anything buffered since, and regardless of the
+            # limit, which only applies to new calls
+            call.resends += 1
+            self._buffer.appendleft(call)
+            return
+
+        call.result.errback(reason)
+
+    def _connect(self):
+        self._reconnect = None
+        self._connecting = self.endpoint.connect(self.factory)
+        self._connecting.addCallbacks(self._connected, self._connectFailed)
+
+    def _connected(self, protocol):
+        self._connecting = None
+        if self._stopped:
+            return protocol.transport.loseConnection()
+
+        self._connectedAt = self.clock.seconds()
+        self._protocol = protocol
+
+        buffered, self._buffer = self._buffer, collections.deque()
+        for call in buffered:
+            self._send(call)
+
+    def _connectFailed(self, reason):
+        self._connecting = None
+        if not self._stopped:
+            self.failures += 1
+            self._scheduleReconnect()
+
+    def _connectionLost(self, protocol):
+        if protocol is not self._protocol:
+            return
+
+        self._protocol = None
+        if not self._stopped:
+            # a peer which accepts connections but then drops them (say,
+            # because a resent request crashes it) gets backed off from too
+            uptime = self.clock.seconds() - self._connectedAt
+            if uptime >= self.maximumDelay:
+                self.failures = 0
+            self.failures += 1
+            self._scheduleReconnect()
+
+    def _scheduleReconnect(self):
+        delay = self.initialDelay * self.factor ** max(self.failures - 1, 0)
+        delay = min(delay, self.maximumDelay)
+        self._reconnect = self.clock.callLater(delay, self._connect)
@@ -1,14 +1,29 @@
 from __future__ import absolute_import
 import json
+import os
+import struct
 
-from twisted.internet import defer, error
+from twisted.internet import defer, endpoints, error, interfaces, reactor
 from twisted.python import failure
 from twisted.test import proto_helpers
 from twisted.trial import unittest
+from zope.interface import implementer
 
 from txjsonrpc import jsonrpc, jsonrpclib
 
 
+@implementer(interfaces.IUNIXTransport)
+class FakeUNIXTransport(proto_helpers.StringTransportWithDisconnection):
+    def __init__(self, *args, **kwargs):
+        proto_helpers.StringTransportWithDisconnection.__init__(
+            self, *args, **kwargs
+        )
+        self.descriptors = []
+
+    def sendFileDescriptor(self, descriptor):
+        self.descriptors.append(os.dup(descriptor))
+
+
 class TestJSONRPC(unittest.TestCase):
     def setUp(self):
         self.deferred = defer.Deferred()
@@ -22,6 +37,8 @@ class TestJSONRPC(unittest.TestCase):
 
         self.factory = jsonrpc.JSONRPCFactory(exposed.get)
         self.proto = self.factory.buildProtocol(("127.0.0.1", 0))
+        # advertising extensions is covered by TestAttachments
+        self.proto.extensions = ()
         self.tr = proto_helpers.StringTransportWithDisconnection()
         self.proto.makeConnection(self.tr)
 
@@ -234,8 +251,407 @@ class TestJSONRPC(unittest.TestCase):
         for d in d1, d2, d3:
             d.addErrback(lambda reason: self.assertIs(reason, exc))
 
+    def test_cancel_request(self):
+        """
+        A cancelled request fails, and its eventual result is ignored.
+
+        """
+
+        d = self.proto.request("foo")
+        d.cancel()
+        self.tr.clear()
+
+        receive = {"jsonrpc" : "2.0", "id" :  "1", "result" : [2, 3, "bar"]}
+        self.proto.stringReceived(json.dumps(receive))
+
+        self.assertEqual(self.tr.value(), "")
+        self.assertTrue(self.tr.connected)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancelled_requests_forgotten(self):
+        """
+        Only the most recently cancelled requests are remembered.
+
+        """
+
+        self.proto.cancelledLimit = 2
+        for _ in range(3):
+            d = self.proto.request("foo")
+            d.addErrback(lambda f : f.trap(defer.CancelledError))
+            d.cancel()
+        self.assertEqual(list(self.proto._cancelled), ["2", "3"])
+
+        receive = {"jsonrpc" : "2.0", "id" :  "3", "result" : None}
+        self.proto.stringReceived(json.dumps(receive))
+        self.assertEqual(list(self.proto._cancelled), ["2"])
+
     def test_connection_lost(self):
         self.proto.connectionLost(failure.Failure(error.ConnectionLost("Bye")))
         return self.proto.request("foo").addErrback(
             lambda f : self.assertIs(f.type, error.ConnectionLost)
         )
+
+
+def frames(data):
+    while data:
+        length, = struct.unpack("!H", data[:2])
+        yield data[2:2 + length]
+        data = data[2 + length:]
+
+
+class OldJSONRPC(jsonrpc.JSONRPC):
+    """
+    Behaves like a peer from before extensions: it never advertises any, and
+    (as before) drops the connection on anything it doesn't understand.
+
+    """
+
+    extensions = ()
+
+
+class OldJSONRPCFactory(jsonrpc.JSONRPCFactory):
+    protocol = OldJSONRPC
+
+
+class TestAttachments(unittest.TestCase):
+    def setUp(self):
+        exposed = {
+            "size" : len,
+            "echo" : lambda *attachments : map(
+                jsonrpclib.Attachment, attachments
+            ),
+        }
+
+        self.factory = jsonrpc.JSONRPCFactory(exposed.get)
+        self.proto = self.factory.buildProtocol(("127.0.0.1", 0))
+        self.tr = proto_helpers.StringTransportWithDisconnection()
+        self.tr.protocol = self.proto
+        self.proto.makeConnection(self.tr)
+
+    def sent(self):
+        sent = list(frames(self.tr.value()))
+        self.tr.clear()
+        return sent
+
+    def receive(self, message, *attachments):
+        message["jsonrpc"] = "2.0"
+        self.proto.stringReceived(json.dumps(message))
+        for attachment in attachments:
+            self.proto.stringReceived(attachment)
+
+    def test_advertised_in_first_message(self):
+        self.proto.notify("foo")
+        self.proto.notify("bar")
+
+        first, second = map(json.loads, self.sent())
+        self.assertEqual(first["extensions"], ["attachments"])
+        self.assertNotIn("extensions", second)
+
+    def test_request(self):
+        self.receive({"method" : "echo", "extensions" : ["attachments"]})
+
+        d = self.proto.request("size", [jsonrpclib.Attachment("x" * 70000)])
+
+        request, first, second = self.sent()
+        self.assertEqual(
+            json.loads(request),
+            {"jsonrpc" : "2.0", "id" : "1", "method" : "size",
+             "params" : [{"$attachment" : 0}], "attachments" : [70000],
+             "extensions" : ["attachments"]}
+        )
+        self.assertEqual(first + second, "x" * 70000)
+
+        self.receive({"id" : "1", "result" : 70000})
+        return d.addCallback(self.assertEqual, 70000)
+
+    def test_request_waits_for_peer(self):
+        pending = self.proto.request("foo")
+        d = self.proto.request("size", [jsonrpclib.Attachment("x")])
+        self.sent()
+
+        self.receive(
+            {"id" : "1", "result" : 2, "extensions" : ["attachments"]}
+        )
+        request, attachment = self.sent()
+        self.assertEqual(json.loads(request)["id"], "2")
+        self.assertEqual(attachment, "x")
+
+        self.receive({"id" : "2", "result" : 1})
+        return defer.gatherResults([pending, d])
+
+    def test_request_peer_has_not_spoken(self):
+        d = self.proto.request("size", [jsonrpclib.Attachment("x")])
+        self.assertEqual(self.sent(), [])
+        self.assertTrue(self.tr.connected)
+        return self.assertFailure(d, jsonrpclib.AttachmentsNotSupported)
+
+    def test_request_peer_extensions_configured(self):
+        self.proto.peerExtensions = ["attachments"]
+        self.proto.notify("size", [jsonrpclib.Attachment("x")])
+        self.assertEqual(len(self.sent()), 2)
+
+    def test_received_request(self):
+        self.receive(
+            {"id" : "1", "method" : "size", "params" : [{"$attachment" : 0}],
+             "attachments" : [70000], "extensions" : ["attachments"]},
+            "x" * 65535, "x" * 4465,
+        )
+        response, = map(json.loads, self.sent())
+        self.assertEqual(response["result"], 70000)
+
+    def test_received_result(self):
+        d = self.proto.request("foo")
+        self.receive(
+            {"id" : "1", "result" : [{"$attachment" : 1}, {"$attachment" : 0}],
+             "attachments" : [3, 0, 3]},
+            "foo", "bar",
+        )
+        return d.addCallback(self.assertEqual, ["", "foo"])
+
+    def test_response(self):
+        self.receive(
+            {"id" : "1", "method" : "echo",
+             "params" : [{"$attachment" : 0}, {"$attachment" : 1}],
+             "attachments" : [3, 3], "extensions" : ["attachments"]},
+            "foo", "bar",
+        )
+
+        response, foo, bar = self.sent()
+        self.assertEqual(
+            json.loads(response),
+            {"jsonrpc" : "2.0", "id" : "1", "attachments" : [3, 3],
+             "result" : [{"$attachment" : 0}, {"$attachment" : 1}],
+             "extensions" : ["attachments"]}
+        )
+        self.assertEqual([foo, bar], ["foo", "bar"])
+
+    def test_response_to_peer_without_extensions(self):
+        self.receive({"id" : "1", "method" : "echo", "params" : ["foo"]})
+
+        response, = map(json.loads, self.sent())
+        self.assertEqual(
+            response["error"]["code"], jsonrpclib.AttachmentsNotSupported.code,
+        )
+        self.assertTrue(self.tr.connected)
+
+    def test_invalid_attachment_size(self):
+        self.receive(
+            {"id" : "1", "method" : "size", "params" : [{"$attachment" : 0}],
+             "attachments" : [2]},
+            "foo",
+        )
+        errors = self.flushLoggedErrors(jsonrpclib.InvalidRequest)
+        self.assertEqual(len(errors), 1)
+
+    def test_attachments_over_maximum(self):
+        self.receive(
+            {"id" : "1", "method" : "size", "params" : [{"$attachment" : 0}],
+             "attachments" : [2 ** 62]},
+        )
+        self.assertIsNone(self.proto._attachments)
+        self.assertFalse(self.tr.connected)
+
+        errors = self.flushLoggedErrors(jsonrpclib.InvalidRequest)
+        self.assertEqual(len(errors), 1)
+
+
+class TestAttachmentsWithOldPeers(unittest.TestCase):
+    @defer.inlineCallbacks
+    def connect(self, server, client):
+        port = reactor.listenTCP(0, server, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        endpoint = endpoints.TCP4ClientEndpoint(
+            reactor, "127.0.0.1", port.getHost().port,
+        )
+        yield endpoints.connectProtocol(endpoint, client)
+        self.addCleanup(client.transport.loseConnection)
+
+    @defer.inlineCallbacks
+    def test_old_server(self):
+        slow = defer.Deferred()
+        exposed = {"slow" : lambda : slow, "size" : len}
+        client = jsonrpc.JSONRPC()
+        yield self.connect(OldJSONRPCFactory(exposed.get), client)
+
+        pending = client.request("slow")
+        d = client.request("size", [jsonrpclib.Attachment("x")])
+        slow.callback(12)
+
+        result = yield pending
+        self.assertEqual(result, 12)
+        yield self.assertFailure(d, jsonrpclib.AttachmentsNotSupported)
+
+        result = yield client.request("size", ["foo"])
+        self.assertEqual(result, 3)
+
+    @defer.inlineCallbacks
+    def test_old_client(self):
+        exposed = {"echo" : jsonrpclib.Attachment, "size" : len}
+        client = OldJSONRPC()
+        yield self.connect(jsonrpc.JSONRPCFactory(exposed.get), client)
+
+        d = client.request("echo", ["foo"])
+        err = yield self.assertFailure(d, jsonrpclib.AttachmentsNotSupported)
+        self.assertIn("reason", err.data)
+
+        result = yield client.request("size", ["foo"])
+        self.assertEqual(result, 3)
+
+
+class TestSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.factory = jsonrpc.JSONRPCFactory(sharedMemoryThreshold=100)
+        self.proto = self.factory.buildProtocol(None)
+        self.tr = FakeUNIXTransport()
+        self.proto.makeConnection(self.tr)
+
+    def tearDown(self):
+        for descriptor in self.tr.descriptors:
+            os.close(descriptor)
+
+    def test_small_messages_are_sent_inline(self):
+        self.proto.notify("foo")
+        self.assertEqual(self.tr.descriptors, [])
+        self.assertEqual(json.loads(self.tr.value()[2:])["method"], "foo")
+
+    def test_large_messages_are_sent_out_of_band(self):
+        self.proto.notify("foo", ["x" * 200])
+
+        reference = json.loads(self.tr.value()[2:])
+        size = reference["sharedMemory"]["size"]
+        self.assertGreater(size, 200)
+
+        descriptor, = self.tr.descriptors
+        with os.fdopen(os.dup(descriptor)) as shared:
+            shared.seek(0)
+            sent = json.loads(shared.read())
+        self.assertEqual(sent["params"], ["x" * 200])
+
+    def test_released_when_acknowledged(self):
+        self.proto.notify("foo", ["x" * 200])
+        self.proto.notify("foo", ["y" * 200])
+        first, second = self.proto._sentSharedMemory
+
+        self.proto.stringReceived(jsonrpclib.sharedMemoryReceived())
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+
+        self.proto.stringReceived(jsonrpclib.sharedMemoryReceived())
+        self.assertTrue(second.closed)
+
+    def test_unexpected_acknowledgement(self):
+        self.proto.stringReceived(jsonrpclib.sharedMemoryReceived())
+        errors = self.flushLoggedErrors(jsonrpclib.InvalidRequest)
+        self.assertEqual(len(errors), 1)
+
+    def test_not_used_without_unix_transport(self):
+        proto = self.factory.buildProtocol(None)
+        tr = proto_helpers.StringTransportWithDisconnection()
+        proto.makeConnection(tr)
+
+        proto.notify("foo", ["x" * 200])
+        self.assertEqual(json.loads(tr.value()[2:])["params"], ["x" * 200])
+
+    def test_received_shared_memory(self):
+        d = self.proto.request("foo")
+        self.tr.clear()
+        response = jsonrpclib.response("1", "x" * 200)
+        shared = jsonrpc._writeSharedMemory(response)
+        self.addCleanup(shared.close)
+
+        self.proto.fileDescriptorReceived(os.dup(shared.fileno()))
+        self.proto.stringReceived(jsonrpclib.sharedMemory(len(response)))
+
+        acknowledgement = json.loads(self.tr.value()[2:])
+        self.assertEqual(acknowledgement["sharedMemoryReceived"], True)
+        return d.addCallback(self.assertEqual, "x" * 200)
+
+    def test_received_shared_memory_too_large(self):
+        self.proto.sharedMemoryThreshold = None
+        shared = jsonrpc._writeSharedMemory("x" * 10)
+        self.addCleanup(shared.close)
+
+        self.proto.fileDescriptorReceived(os.dup(shared.fileno()))
+        self.proto.stringReceived(jsonrpclib.sharedMemory(100))
+
+        sent = json.loads(list(frames(self.tr.value()))[-1])
+        self.assertEqual(sent["error"]["data"]["exception"], "ValueError")
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_received_shared_memory_over_maximum(self):
+        self.proto.sharedMemoryThreshold = None
+        shared = jsonrpc._writeSharedMemory("x" * 10)
+        self.addCleanup(shared.close)
+
+        self.proto.fileDescriptorReceived(os.dup(shared.fileno()))
+        self.proto.stringReceived(jsonrpclib.sharedMemory(2 ** 70))
+
+        sent = json.loads(list(frames(self.tr.value()))[-1])
+        self.assertEqual(sent["error"]["code"], jsonrpclib.InvalidRequest.code)
+        self.assertEqual(
+            len(self.flushLoggedErrors(jsonrpclib.InvalidRequest)), 1,
+        )
+
+    def test_received_shared_memory_bad_descriptor(self):
+        self.proto.sharedMemoryThreshold = None
+        shared = jsonrpc._writeSharedMemory("x" * 10)
+        descriptor = os.dup(shared.fileno())
+        shared.close()
+        os.close(descriptor)
+
+        self.proto.fileDescriptorReceived(descriptor)
+        self.proto.stringReceived(jsonrpclib.sharedMemory(10))
+
+        sent = json.loads(list(frames(self.tr.value()))[-1])
+        self.assertIn("error", sent)
+        self.assertEqual(len(self.flushLoggedErrors(EnvironmentError)), 1)
+
+    def test_received_shared_memory_without_descriptor(self):
+        self.proto.stringReceived(jsonrpclib.sharedMemory(100))
+        errors = self.flushLoggedErrors(jsonrpclib.InvalidRequest)
+        self.assertEqual(len(errors), 1)
+
+
+class TestUNIXTransport(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_request(self):
+        """
+        Requests can be made over a UNIX socket, with results larger than fit
+        in a single length-prefixed frame passed through shared memory.
+
+        """
+
+        exposed = {"big" : lambda size : "x" * size}
+        server = jsonrpc.JSONRPCFactory(
+            exposed.get, sharedMemoryThreshold=1024,
+        )
+        path = self.mktemp()
+        port = reactor.listenUNIX(path, server)
+        self.addCleanup(port.stopListening)
+
+        client = jsonrpc.JSONRPC()
+        endpoint = endpoints.UNIXClientEndpoint(reactor, path)
+        yield endpoints.connectProtocol(endpoint, client)
+        self.addCleanup(client.transport.loseConnection)
+
+        result = yield client.request("big", [2 ** 20])
+        self.assertEqual(result, "x" * 2 ** 20)
+
+    @defer.inlineCallbacks
+    def test_attachments(self):
+        exposed = {"reverse" : lambda data : jsonrpclib.Attachment(data[::-1])}
+        path = self.mktemp()
+        port = reactor.listenUNIX(path, jsonrpc.JSONRPCFactory(exposed.get))
+        self.addCleanup(port.stopListening)
+
+        client = jsonrpc.JSONRPC()
+        client.peerExtensions = [jsonrpclib.ATTACHMENTS]
+        endpoint = endpoints.UNIXClientEndpoint(reactor, path)
+        yield endpoints.connectProtocol(endpoint, client)
+        self.addCleanup(client.transport.loseConnection)
+
+        data = "".join(chr(i % 256) for i in xrange(2 ** 17))
+        params = [jsonrpclib.Attachment(data)]
+        result = yield client.request("reverse", params)
+        self.assertEqual(result, data[::-1])
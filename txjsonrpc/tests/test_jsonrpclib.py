@@ -37,6 +37,79 @@ class TestJSONRPCLib(unittest.TestCase):
              "method" : "bar", "params" : [1, 2, "foo"]}
         )
 
+    def test_request_attachments(self):
+        attachments = []
+        req = j.request("1", "foo", [j.Attachment("abc"), 2], attachments)
+        self.assertEqual(
+            json.loads(req),
+            {"jsonrpc" : "2.0", "id" : "1", "method" : "foo",
+             "params" : [{"$attachment" : 0}, 2], "attachments" : [3]}
+        )
+        self.assertEqual(attachments, ["abc"])
+
+    def test_response_attachments(self):
+        attachments = []
+        result = {"a" : j.Attachment("ab"), "b" : [j.Attachment("")]}
+        self.assertEqual(
+            json.loads(j.response("1", result, attachments)),
+            {"jsonrpc" : "2.0", "id" : "1", "attachments" : [2, 0],
+             "result" : {"a" : {"$attachment" : 0},
+                         "b" : [{"$attachment" : 1}]}}
+        )
+        self.assertEqual(sorted(attachments), ["", "ab"])
+
+    def test_no_attachments(self):
+        attachments = []
+        self.assertEqual(
+            json.loads(j.notify("foo", [1], attachments)),
+            {"jsonrpc" : "2.0", "method" : "foo", "params" : [1]}
+        )
+        self.assertEqual(attachments, [])
+
+    def test_attachments_not_requested(self):
+        with self.assertRaises(TypeError):
+            j.notify("foo", [j.Attachment("abc")])
+
+    def test_resolve_attachments(self):
+        obj = {"a" : [{"$attachment" : 1}, {"$attachment" : 0, "b" : 2}]}
+        self.assertEqual(
+            j.resolveAttachments(obj, ["foo", "bar"]),
+            {"a" : ["bar", {"$attachment" : 0, "b" : 2}]}
+        )
+
+        for invalid in [
+            {"$attachment" : 2},
+            {"$attachment" : "0"},
+            {"$attachment" : True},
+            {"$attachment" : -1},
+        ]:
+            with self.assertRaises(j.InvalidRequest):
+                j.resolveAttachments(invalid, ["foo"])
+
+    def test_received_attachments(self):
+        r = {"jsonrpc" : "2.0", "method" : "foo", "attachments" : [1, 0]}
+        self.assertEqual(j.receivedAttachments(r), [1, 0])
+        self.assertEqual(j.receivedAttachments(r, maximum=1), [1, 0])
+        with self.assertRaises(j.InvalidRequest):
+            j.receivedAttachments({"attachments" : [1, 1]}, maximum=1)
+
+        for invalid in [3, [-1], ["1"], [True]]:
+            with self.assertRaises(j.InvalidRequest):
+                r["attachments"] = invalid
+                j.receivedAttachments(r)
+
+    def test_shared_memory(self):
+        self.assertEqual(
+            json.loads(j.sharedMemory(2048)),
+            {"jsonrpc" : "2.0", "sharedMemory" : {"size" : 2048}}
+        )
+
+    def test_shared_memory_received(self):
+        self.assertEqual(
+            json.loads(j.sharedMemoryReceived()),
+            {"jsonrpc" : "2.0", "sharedMemoryReceived" : True}
+        )
+
     def test_loads(self):
         with self.assertRaises(j.ParseError):
             j.loads("bigboom")
@@ -73,6 +146,24 @@ class TestJSONRPCLib(unittest.TestCase):
             r = {"jsonrpc" : "2.0", "id" : "4", "method": "qu", "params" : 2}
             j.receivedRequest(r, {"qu" : next}.get)
 
+    def test_received_shared_memory(self):
+        r = {"jsonrpc" : "2.0", "sharedMemory" : {"size" : 2048}}
+        self.assertEqual(j.receivedSharedMemory(r), 2048)
+        self.assertEqual(j.receivedSharedMemory(r, maximum=2048), 2048)
+        with self.assertRaises(j.InvalidRequest):
+            j.receivedSharedMemory(r, maximum=2047)
+
+    def test_received_shared_memory_invalid(self):
+        for invalid in [
+            {"sharedMemory" : {"size" : 2048}},
+            {"jsonrpc" : "2.0", "sharedMemory" : {}},
+            {"jsonrpc" : "2.0", "sharedMemory" : 12},
+            {"jsonrpc" : "2.0", "sharedMemory" : {"size" : "big"}},
+            {"jsonrpc" : "2.0", "sharedMemory" : {"size" : 0}},
+        ]:
+            with self.assertRaises(j.InvalidRequest):
+                j.receivedSharedMemory(invalid)
+
     def test_received_response(self):
         r = {"jsonrpc" : "2.0", "id" : "1", "result": [1, 2, 3]}
         self.assertEqual(j.receivedResult(r), r)
@@ -123,6 +214,15 @@ class TestJSONRPCLib(unittest.TestCase):
         self.assertEqual(err.exception.message, "Foo blew up")
         self.assertEqual(err.exception.code, -29)
 
+    def test_received_extension_error(self):
+        err = j.AttachmentsNotSupported()
+        r = {"jsonrpc" : "2.0", "id" : "1", "error" : err.toResponse()}
+
+        with self.assertRaises(j.AttachmentsNotSupported) as e:
+            j.receivedResult(r)
+        self.assertEqual(e.exception.data, err.data)
+        self.assertIn("reason", err.data)
+
     def test_received_error_invalid(self):
         r = {"jsonrpc" : "2.0", "id" : "1"}
 
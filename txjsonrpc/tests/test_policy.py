@@ -0,0 +1,282 @@
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txjsonrpc import jsonrpclib, policy
+
+
+class FakeConnection(object):
+    connected = True
+
+    def __init__(self):
+        self.requests = []
+        self.notifications = []
+        self.cancelled = []
+
+    def request(self, method, parameters=()):
+        d = defer.Deferred(self.cancelled.append)
+        self.requests.append((method, parameters, d))
+        return d
+
+    def notify(self, method, parameters=()):
+        self.notifications.append((method, parameters))
+
+
+class TestRetryBudget(unittest.TestCase):
+    def test_withdraw(self):
+        budget = policy.RetryBudget(ratio=0.5, capacity=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_capacity(self):
+        budget = policy.RetryBudget(ratio=1, capacity=2)
+        for _ in range(5):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 2)
+
+
+class TestHedge(unittest.TestCase):
+    def test_fixed_delay(self):
+        self.assertEqual(policy.Hedge(delay=3).delayFor([]), 3)
+
+    def test_observed_percentile(self):
+        hedge = policy.Hedge(percentile=0.9, minimumSamples=5)
+        self.assertIsNone(hedge.delayFor([1, 2, 3, 4]))
+        self.assertEqual(hedge.delayFor(range(10, 0, -1)), 10)
+        self.assertEqual(hedge.delayFor(range(100)), 90)
+
+
+class TestRetry(unittest.TestCase):
+    def test_should_retry(self):
+        retry = policy.Retry(codes=[-32001], maximum=2)
+        busy = failure.Failure(jsonrpclib.ServerError(code=-32001))
+        other = failure.Failure(jsonrpclib.ServerError(code=-32002))
+        value = failure.Failure(ValueError())
+
+        self.assertTrue(retry.shouldRetry(busy, 0))
+        self.assertTrue(retry.shouldRetry(busy, 1))
+        self.assertFalse(retry.shouldRetry(busy, 2))
+        self.assertFalse(retry.shouldRetry(other, 0))
+        self.assertFalse(retry.shouldRetry(value, 0))
+
+    def test_delay(self):
+        retry = policy.Retry(
+            codes=(), initialDelay=1, maximumDelay=5, random=lambda : 0.5,
+        )
+        self.assertEqual(
+            [retry.delayFor(retries) for retries in range(5)],
+            [0.5, 1, 2, 2.5, 2.5],
+        )
+
+
+class TestPolicyClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = [FakeConnection(), FakeConnection()]
+
+    def client(self, **kwargs):
+        kwargs.setdefault("idempotent", ["get"])
+        return policy.PolicyClient(
+            self.connections, clock=self.clock, **kwargs
+        )
+
+    def test_not_idempotent(self):
+        client = self.client(hedge=policy.Hedge(delay=1))
+        d = client.request("set", [1])
+
+        (method, parameters, sent), = self.connections[0].requests
+        self.assertEqual((method, parameters), ("set", [1]))
+        self.assertIs(d, sent)
+
+        self.clock.advance(5)
+        self.assertEqual(self.connections[1].requests, [])
+
+    def test_notify(self):
+        self.client().notify("foo", [1])
+        self.assertEqual(self.connections[0].notifications, [("foo", [1])])
+
+    def test_skips_disconnected(self):
+        self.connections[0].connected = False
+        client = self.client()
+        client.request("set")
+        client.request("get")
+        self.assertEqual(self.connections[0].requests, [])
+        self.assertEqual(len(self.connections[1].requests), 2)
+
+    def test_all_disconnected(self):
+        for connection in self.connections:
+            connection.connected = False
+        self.client().request("set")
+        requests = [c.requests for c in self.connections]
+        self.assertEqual(sorted(map(len, requests)), [0, 1])
+
+    def test_resent_when_connection_lost(self):
+        d = self.client().request("get", [1])
+
+        lost = error.ConnectionLost()
+        self.connections[0].requests[0][2].errback(lost)
+        (method, parameters, resent), = self.connections[1].requests
+        self.assertEqual((method, parameters), ("get", [1]))
+
+        resent.callback(4)
+        return d.addCallback(self.assertEqual, 4)
+
+    def test_resent_once_per_connection(self):
+        d = self.client().request("get")
+
+        first, second = self.connections
+        for connection in first, second, first:
+            self.assertNoResult(d)
+            connection.requests.pop()[2].errback(error.ConnectionLost())
+        return self.assertFailure(d, error.ConnectionLost)
+
+    def test_no_hedge_if_answered(self):
+        client = self.client(hedge=policy.Hedge(delay=1))
+        d = client.request("get")
+
+        self.connections[0].requests[0][2].callback(12)
+        self.clock.advance(5)
+
+        self.assertEqual(self.connections[1].requests, [])
+        return d.addCallback(self.assertEqual, 12)
+
+    def test_hedge(self):
+        client = self.client(hedge=policy.Hedge(delay=1))
+        d = client.request("get", [2])
+
+        self.clock.advance(1)
+        (_, _, first), = self.connections[0].requests
+        (method, parameters, second), = self.connections[1].requests
+        self.assertEqual((method, parameters), ("get", [2]))
+
+        second.callback("hedged")
+        self.assertEqual(self.connections[0].cancelled, [first])
+        return d.addCallback(self.assertEqual, "hedged")
+
+    def test_hedge_observed_latency(self):
+        client = self.client(hedge=policy.Hedge(minimumSamples=2))
+
+        for _ in range(2):
+            client.request("get")
+            self.clock.advance(3)
+            for connection in self.connections:
+                if connection.requests:
+                    connection.requests.pop()[2].callback(None)
+
+        client.request("get")
+        self.clock.advance(2.9)
+        self.assertEqual(self.connections[1].requests, [])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.connections[1].requests), 1)
+
+    def test_hedges_of_overlapping_calls(self):
+        client = self.client(hedge=policy.Hedge(delay=1))
+        client.request("get", ["a"])
+        client.request("get", ["b"])
+
+        self.clock.advance(1)
+        for connection in self.connections:
+            self.assertEqual(
+                sorted(params for _, params, _ in connection.requests),
+                [["a"], ["b"]],
+            )
+
+    def test_retry_skips_disconnected(self):
+        self.connections.append(FakeConnection())
+        retry = policy.Retry(codes=[-32001], random=lambda : 1)
+        client = self.client(retry=retry)
+        client.request("get")
+
+        self.connections[1].connected = False
+        busy = jsonrpclib.ServerError(code=-32001)
+        self.connections[0].requests[0][2].errback(busy)
+        self.clock.advance(retry.initialDelay)
+
+        self.assertEqual(self.connections[1].requests, [])
+        self.assertEqual(len(self.connections[2].requests), 1)
+
+    def test_hedged_latency_includes_original(self):
+        client = self.client(hedge=policy.Hedge(delay=1))
+        client.request("get")
+
+        self.clock.advance(1.5)
+        self.connections[1].requests[0][2].callback(None)
+        self.assertEqual(list(client.latencies("get")), [1.5])
+
+    def test_hedge_needs_budget(self):
+        budget = policy.RetryBudget(ratio=0, capacity=0)
+        client = self.client(hedge=policy.Hedge(delay=1), budget=budget)
+        client.request("get")
+
+        self.clock.advance(1)
+        self.assertEqual(self.connections[1].requests, [])
+
+    def test_retry(self):
+        retry = policy.Retry(codes=[-32001], random=lambda : 1)
+        client = self.client(retry=retry)
+        d = client.request("get")
+
+        busy = jsonrpclib.ServerError(code=-32001)
+        self.connections[0].requests[0][2].errback(busy)
+
+        self.assertEqual(self.connections[1].requests, [])
+        self.clock.advance(retry.initialDelay)
+        self.connections[1].requests[0][2].callback(3)
+        return d.addCallback(self.assertEqual, 3)
+
+    def test_retry_gives_up(self):
+        retry = policy.Retry(codes=[-32001], maximum=1, random=lambda : 1)
+        client = self.client(retry=retry)
+        d = client.request("get")
+
+        busy = jsonrpclib.ServerError(code=-32001)
+        self.connections[0].requests[0][2].errback(busy)
+        self.clock.advance(retry.initialDelay)
+        self.connections[1].requests[0][2].errback(busy)
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, jsonrpclib.ServerError)
+
+    def test_retry_needs_budget(self):
+        budget = policy.RetryBudget(ratio=0, capacity=0)
+        retry = policy.Retry(codes=[-32001])
+        d = self.client(retry=retry, budget=budget).request("get")
+
+        busy = jsonrpclib.ServerError(code=-32001)
+        self.connections[0].requests[0][2].errback(busy)
+        return self.assertFailure(d, jsonrpclib.ServerError)
+
+    def test_not_retryable(self):
+        retry = policy.Retry(codes=[-32001])
+        d = self.client(retry=retry).request("get")
+
+        self.connections[0].requests[0][2].errback(jsonrpclib.InvalidParams())
+        return self.assertFailure(d, jsonrpclib.InvalidParams)
+
+    def test_failure_while_hedge_outstanding(self):
+        client = self.client(hedge=policy.Hedge(delay=1))
+        d = client.request("get")
+        self.clock.advance(1)
+
+        self.connections[0].requests[0][2].errback(jsonrpclib.InternalError())
+        self.assertNoResult(d)
+
+        self.connections[1].requests[0][2].callback(7)
+        return d.addCallback(self.assertEqual, 7)
+
+    def test_cancel(self):
+        retry = policy.Retry(codes=[-32001])
+        client = self.client(hedge=policy.Hedge(delay=1), retry=retry)
+        d = client.request("get")
+        d.cancel()
+
+        (_, _, first), = self.connections[0].requests
+        self.assertEqual(self.connections[0].cancelled, [first])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, defer.CancelledError)
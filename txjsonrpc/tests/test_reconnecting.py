@@ -0,0 +1,221 @@
+import json
+
+from twisted.internet import defer, error, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txjsonrpc import jsonrpclib, reconnecting
+
+
+class FakeEndpoint(object):
+    def __init__(self):
+        self.connecting = []
+
+    def connect(self, factory):
+        d = defer.Deferred()
+        self.connecting.append((factory, d))
+        return d
+
+    def succeed(self):
+        factory, d = self.connecting.pop(0)
+        proto = factory.buildProtocol(None)
+        tr = proto_helpers.StringTransportWithDisconnection()
+        tr.protocol = proto
+        proto.makeConnection(tr)
+        d.callback(proto)
+        return tr
+
+    def fail(self):
+        factory, d = self.connecting.pop(0)
+        d.errback(error.ConnectionRefusedError())
+
+
+def sent(tr):
+    return json.loads(tr.value()[2:])
+
+
+class TestReconnectingClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.endpoint = FakeEndpoint()
+        self.client = reconnecting.ReconnectingClient(
+            self.endpoint, idempotent=["get"], bufferLimit=2, maxResends=2,
+            initialDelay=1, maximumDelay=5, clock=self.clock,
+        )
+        self.client.start()
+
+    def test_request(self):
+        tr = self.endpoint.succeed()
+        self.assertTrue(self.client.connected)
+
+        d = self.client.request("get", [1])
+        self.assertEqual(
+            sent(tr),
+            {"jsonrpc" : "2.0", "id" : "1", "method" : "get", "params" : [1],
+             "extensions" : ["attachments"]},
+        )
+
+        tr.protocol.stringReceived(
+            json.dumps({"jsonrpc" : "2.0", "id" : "1", "result" : 2})
+        )
+        return d.addCallback(self.assertEqual, 2)
+
+    def test_buffered_until_connected(self):
+        d = self.client.request("set", [1])
+        self.client.notify("foo")
+
+        tr = self.endpoint.succeed()
+        requests = tr.value()
+        self.assertIn('"set"', requests)
+        self.assertIn('"foo"', requests)
+        self.assertNoResult(d)
+
+    def test_buffer_limit(self):
+        self.client.request("get")
+        self.client.request("get")
+        d = self.client.request("get")
+        return self.assertFailure(d, reconnecting.BufferFull)
+
+    def test_reconnect_backoff(self):
+        for delay in 1, 2, 4, 5, 5:
+            self.endpoint.fail()
+            self.clock.advance(delay - 0.01)
+            self.assertEqual(self.endpoint.connecting, [])
+            self.clock.advance(0.01)
+            self.assertEqual(len(self.endpoint.connecting), 1)
+
+        tr = self.endpoint.succeed()
+        tr.loseConnection()
+        self.assertFalse(self.client.connected)
+
+        self.clock.advance(4.99)
+        self.assertEqual(self.endpoint.connecting, [])
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.endpoint.connecting), 1)
+
+    def test_crash_loop(self):
+        d = self.client.request("get")
+
+        for delay in 1, 2, 4:
+            tr = self.endpoint.succeed()
+            self.assertEqual(sent(tr)["method"], "get")
+            tr.loseConnection()
+
+            self.clock.advance(delay - 0.01)
+            self.assertEqual(self.endpoint.connecting, [])
+            self.clock.advance(0.01)
+
+        return self.assertFailure(d, error.ConnectionDone)
+
+    def test_backoff_reset_by_response(self):
+        self.endpoint.fail()
+        self.clock.advance(1)
+        self.endpoint.fail()
+        self.clock.advance(2)
+
+        tr = self.endpoint.succeed()
+        self.client.request("set")
+        tr.protocol.stringReceived(
+            json.dumps({"jsonrpc" : "2.0", "id" : "1", "result" : 2})
+        )
+        tr.loseConnection()
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.endpoint.connecting), 1)
+
+    def test_backoff_reset_by_error_response(self):
+        self.endpoint.fail()
+        self.clock.advance(1)
+        self.endpoint.fail()
+        self.clock.advance(2)
+
+        tr = self.endpoint.succeed()
+        d = self.client.request("set")
+        err = {"code" : -32603, "message" : "Internal error"}
+        tr.protocol.stringReceived(
+            json.dumps({"jsonrpc" : "2.0", "id" : "1", "error" : err})
+        )
+        tr.loseConnection()
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.endpoint.connecting), 1)
+        return self.assertFailure(d, jsonrpclib.InternalError)
+
+    def test_backoff_reset_by_stable_connection(self):
+        self.endpoint.fail()
+        self.clock.advance(1)
+        self.endpoint.fail()
+        self.clock.advance(2)
+
+        tr = self.endpoint.succeed()
+        self.clock.advance(5)
+        tr.loseConnection()
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.endpoint.connecting), 1)
+
+    def test_idempotent_requests_resent(self):
+        tr = self.endpoint.succeed()
+        d = self.client.request("get", [1])
+        tr.loseConnection()
+        self.assertNoResult(d)
+
+        self.clock.advance(1)
+        tr = self.endpoint.succeed()
+        self.assertEqual(sent(tr)["params"], [1])
+
+        tr.protocol.stringReceived(
+            json.dumps({"jsonrpc" : "2.0", "id" : "1", "result" : 2})
+        )
+        return d.addCallback(self.assertEqual, 2)
+
+    def test_other_requests_fail(self):
+        tr = self.endpoint.succeed()
+        d = self.client.request("set", [1])
+        tr.loseConnection()
+        return self.assertFailure(d, error.ConnectionDone)
+
+    def test_call_made_while_disconnecting(self):
+        tr = self.endpoint.succeed()
+        later = []
+
+        d = self.client.request("set")
+        d.addErrback(lambda _ : later.append(self.client.request("set2")))
+        tr.loseConnection()
+
+        d, = later
+        self.assertNoResult(d)
+
+        self.clock.advance(1)
+        tr = self.endpoint.succeed()
+        self.assertEqual(sent(tr)["method"], "set2")
+
+    def test_cancel_buffered(self):
+        d = self.client.request("get")
+        d.cancel()
+
+        tr = self.endpoint.succeed()
+        self.assertEqual(tr.value(), "")
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_stop(self):
+        tr = self.endpoint.succeed()
+        inFlight = self.client.request("get")
+        tr.loseConnection()
+        buffered = self.client.request("set")
+
+        self.client.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        for d in inFlight, buffered:
+            self.assertFailure(d, error.ConnectionDone)
+        return defer.gatherResults([inFlight, buffered])
+
+    def test_stop_connected(self):
+        tr = self.endpoint.succeed()
+        d = self.client.request("get")
+
+        self.client.stop()
+        self.assertFalse(tr.connected)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, error.ConnectionDone)